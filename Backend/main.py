@@ -1,5 +1,7 @@
 import os
 import base64
+import csv
+import re
 import pandas as pd
 from openai import OpenAI
 from dotenv import load_dotenv
@@ -18,6 +20,14 @@ client = OpenAI(api_key=api_key)
 # Base URL for the server
 base_url = "https://tms.deebugger.de/bd34634c-0876-4f8f-b506-2e6cf19d34be"
 
+# Keys that have to be present in the data extracted from the overview image
+OVERVIEW_KEYS = [
+    "Laufzeit Heute", "Vorrat", "Gesamt Heute", "Gesamt Gestern", "Aktuell", "LR1", "Pumpe",
+    "Betriebsst. F TR", "Betriebsst. F LR2", "Betriebsst. F LR1", "Betriebsst. GRL TR1",
+    "Betriebsst. GRL TR2", "Betriebsst. GRL TR3", "Betriebsst. VG Pumpe", "Betriebsst. Fackel",
+    "Betriebsst. BHKW", "Gas Gesamt BHKW"
+]
+
 # Function to check if there are new images available
 def check_for_new_images():
     """
@@ -113,8 +123,173 @@ def get_image_data(image_path):
             print(f"Error reading local image file: {str(e)}")
             raise
 
+# Function to yield the text of a streamed model response as it arrives
+def iter_stream_text(stream):
+    """
+    Yield the output text deltas of a streamed response
+
+    Args:
+        stream: Event stream returned by client.responses.create(..., stream=True)
+
+    Raises:
+        RuntimeError: If the response fails or is cut off before it is complete
+    """
+    for event in stream:
+        if event.type == "response.output_text.delta":
+            yield event.delta
+        elif event.type in ("response.failed", "response.incomplete", "error"):
+            raise RuntimeError(f"Streaming response did not complete ({event.type}): {event}")
+
+# Function to parse a single CSV line into its fields
+def parse_csv_line(line):
+    """
+    Parse one line of model output into its CSV fields
+
+    Returns:
+        list: The stripped fields, or None if the line is not a row with at least two columns
+    """
+    try:
+        fields = next(csv.reader([line]))
+    except csv.Error:
+        fields = line.split(',')
+    fields = [field.strip() for field in fields]
+    if len(fields) < 2 or not fields[0]:
+        return None
+    return fields
+
+# Function to parse CSV rows from streamed text
+def stream_csv_rows(text_chunks, max_bad_lines=3, header=None):
+    """
+    Parse CSV rows from streamed text as soon as each line is complete
+
+    As with pd.read_csv, the first row of the table is its header. Rows are passed on as soon
+    as they arrive, so an introduction line that contains a comma and is not followed by a code
+    fence becomes the header, just as it would for pd.read_csv. Introduction lines ending in ':'
+    and text before an opening code fence are skipped.
+
+    Args:
+        text_chunks: Iterable of text fragments, e.g. from iter_stream_text
+        max_bad_lines: Number of lines that are not CSV rows before the table starts, after which
+            the output counts as malformed. Once the table has data rows, such lines (section
+            titles, closing remarks) are ignored.
+        header: Optional list that receives the fields of the header row
+
+    Yields:
+        list: The fields of each data row
+
+    Raises:
+        ValueError: If more than max_bad_lines lines precede the first data row
+    """
+    buffer = ""
+    bad_lines = 0
+    table_header = None
+    rows_seen = 0
+    fence_seen = False
+    done = False
+
+    def handle_line(line):
+        nonlocal bad_lines, table_header, rows_seen, fence_seen, done
+        line = line.strip()
+        if not line:
+            return None
+        # Markdown code fences: the first one opens the table unless it already has data rows,
+        # any other one closes it
+        if line.startswith("```"):
+            if fence_seen or rows_seen:
+                done = True
+            else:
+                # Anything before the opening fence was introduction
+                fence_seen = True
+                table_header = None
+                bad_lines = 0
+                if header is not None:
+                    header.clear()
+            return None
+        row = parse_csv_line(line)
+        if row is None or (table_header is None and row[-1].endswith(":")):
+            if not rows_seen:
+                bad_lines += 1
+                if bad_lines > max_bad_lines:
+                    raise ValueError(f"Malformed CSV output, {bad_lines} lines are not CSV rows (last: {line!r})")
+            return None
+        if table_header is None:
+            table_header = row
+            if header is not None:
+                header[:] = row
+            return None
+        # Skip repeated header rows
+        if [field.casefold() for field in row] == [field.casefold() for field in table_header]:
+            return None
+        rows_seen += 1
+        return row
+
+    for chunk in text_chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split('\n')
+        for line in lines:
+            row = handle_line(line)
+            if row:
+                yield row
+            if done:
+                return
+
+    row = handle_line(buffer)
+    if row:
+        yield row
+
+# Function to normalise a parameter name for comparison
+def normalize_key(name):
+    return " ".join(str(name).split()).casefold()
+
+# Function to find required keys that are missing from the extracted data
+def find_missing_keys(df, required_keys):
+    """
+    Return the required keys that do not appear in the Parameter column of the dataframe
+
+    A key is found by a parameter with the same normalised name, or otherwise by a parameter
+    that contains it as a whole word. Each parameter can only account for one key, and longer
+    keys are matched first so that e.g. 'LR1' is not satisfied by 'Betriebsst. F LR1'.
+    """
+    parameters = [] if df.empty else [normalize_key(p) for p in df.iloc[:, 0]]
+    keys = [normalize_key(k) for k in required_keys]
+    used = set()
+    found = set()
+
+    # Exact matches first
+    for i, key in enumerate(keys):
+        for j, parameter in enumerate(parameters):
+            if j not in used and parameter == key:
+                used.add(j)
+                found.add(i)
+                break
+
+    # Then whole-word matches, longest keys first
+    for i in sorted(set(range(len(keys))) - found, key=lambda i: -len(keys[i])):
+        pattern = re.compile(rf"(?<!\w){re.escape(keys[i])}(?!\w)")
+        for j, parameter in enumerate(parameters):
+            if j not in used and pattern.search(parameter):
+                used.add(j)
+                found.add(i)
+                break
+
+    return [key for i, key in enumerate(required_keys) if i not in found]
+
 # Function to process image and extract data with retry logic
-def process_image(image_path, prompt, sheet_name, max_retries=3):
+def process_image(image_path, prompt, sheet_name, max_retries=3, stream=False, required_keys=None, on_row=None):
+    """
+    Extract parameter-value pairs from an image using the model
+
+    Args:
+        image_path: Local file path or URL of the image
+        prompt: Prompt sent along with the image
+        sheet_name: Name of the sheet the data belongs to
+        max_retries: Maximum number of attempts
+        stream: If True, parse rows while the response is streamed and abort malformed output early
+        required_keys: Keys that have to be present, missing keys trigger a retry
+        on_row: Optional callback on_row(sheet_name, attempt, row), called with the fields of each
+            streamed data row as soon as it is parsed. Rows of an attempt that is retried are
+            superseded by the rows of the next attempt. Errors raised by the callback are logged.
+    """
     print(f"Processing image: {image_path}")
     
     for attempt in range(1, max_retries + 1):
@@ -123,71 +298,96 @@ def process_image(image_path, prompt, sheet_name, max_retries=3):
         try:
             # For URL images, we can pass the URL directly to the API
             if image_path.startswith(('http://', 'https://')):
-                # Make API request with URL
-                response = client.responses.create(
-                    model="gpt-4o",
-                    input=[
-                        {
-                            "role": "user",
-                            "content": [
-                                { "type": "input_text", "text": prompt },
-                                {
-                                    "type": "input_image",
-                                    "image_url": image_path,
-                                },
-                            ],
-                        }
-                    ],
-                    temperature=0.1,  # Lower temperature for more deterministic results
-                )
+                image_url = image_path
             else:
                 # For local files, encode and use base64
                 image_data = get_image_data(image_path)
                 base64_image = base64.b64encode(image_data).decode("utf-8")
+                image_url = f"data:image/jpeg;base64,{base64_image}"
+            
+            request_input = [
+                {
+                    "role": "user",
+                    "content": [
+                        { "type": "input_text", "text": prompt },
+                        {
+                            "type": "input_image",
+                            "image_url": image_url,
+                        },
+                    ],
+                }
+            ]
+            
+            if stream:
+                # Parse rows as tokens arrive so malformed output is detected before the response is complete
+                response_stream = client.responses.create(
+                    model="gpt-4o",
+                    input=request_input,
+                    temperature=0.1,  # Lower temperature for more deterministic results
+                    stream=True,
+                )
+                rows = []
+                header = []
+                try:
+                    for row in stream_csv_rows(iter_stream_text(response_stream), header=header):
+                        rows.append(row)
+                        if on_row:
+                            # Errors of the consumer are not a failed attempt, so they must not trigger a retry
+                            try:
+                                on_row(sheet_name, attempt, row)
+                            except Exception as e:
+                                print(f"Error in on_row callback: {str(e)}")
+                finally:
+                    # Stop generation if parsing finished or aborted early
+                    response_stream.close()
+                
+                print(f"Streamed {len(rows)} rows")
                 
-                # Make API request with base64 encoded image
+                # Build the dataframe with read_csv so column names and types match the non-streaming path
+                csv_buffer = StringIO()
+                csv_writer = csv.writer(csv_buffer)
+                if header:
+                    csv_writer.writerow(header)
+                csv_writer.writerows(rows)
+                try:
+                    csv_buffer.seek(0)
+                    df = pd.read_csv(csv_buffer)
+                except:
+                    # If that fails, fall back to parameter-value pairs like the non-streaming path
+                    data = [{"Parameter": row[0], "Value": ','.join(row[1:])} for row in [header] + rows if row]
+                    df = pd.DataFrame(data, columns=["Parameter", "Value"])
+            else:
                 response = client.responses.create(
                     model="gpt-4o",
-                    input=[
-                        {
-                            "role": "user",
-                            "content": [
-                                { "type": "input_text", "text": prompt },
-                                {
-                                    "type": "input_image",
-                                    "image_url": f"data:image/jpeg;base64,{base64_image}",
-                                },
-                            ],
-                        }
-                    ],
-                    temperature=0.1,
+                    input=request_input,
+                    temperature=0.1,  # Lower temperature for more deterministic results
                 )
-            
-            # Get the response text
-            csv_text = response.output_text
-            
-            # Log response for debugging
-            print(f"Response length: {len(csv_text)} characters")
-            
-            # Clean up the response if needed (remove markdown code blocks if present)
-            if csv_text.startswith("```csv"):
-                csv_text = csv_text.replace("```csv", "").replace("```", "").strip()
-            
-            # Parse based on the format (try both methods)
-            try:
-                # Try reading as a standard CSV first
-                df = pd.read_csv(StringIO(csv_text))
-            except:
-                # If that fails, parse it manually by splitting each line
-                lines = csv_text.strip().split('\n')
-                data = []
-                for line in lines:
-                    if ',' in line:
-                        # Split only on the first comma to handle values that may contain commas
-                        parameter, value = line.split(',', 1)
-                        data.append({"Parameter": parameter.strip(), "Value": value.strip()})
                 
-                df = pd.DataFrame(data)
+                # Get the response text
+                csv_text = response.output_text
+                
+                # Log response for debugging
+                print(f"Response length: {len(csv_text)} characters")
+                
+                # Clean up the response if needed (remove markdown code blocks if present)
+                if csv_text.startswith("```csv"):
+                    csv_text = csv_text.replace("```csv", "").replace("```", "").strip()
+                
+                # Parse based on the format (try both methods)
+                try:
+                    # Try reading as a standard CSV first
+                    df = pd.read_csv(StringIO(csv_text))
+                except:
+                    # If that fails, parse it manually by splitting each line
+                    lines = csv_text.strip().split('\n')
+                    data = []
+                    for line in lines:
+                        if ',' in line:
+                            # Split only on the first comma to handle values that may contain commas
+                            parameter, value = line.split(',', 1)
+                            data.append({"Parameter": parameter.strip(), "Value": value.strip()})
+                    
+                    df = pd.DataFrame(data)
             
             # Check if the dataframe is empty or has only one row/column
             if len(df) <= 1 or len(df.columns) <= 1:
@@ -213,6 +413,18 @@ def process_image(image_path, prompt, sheet_name, max_retries=3):
                     time.sleep(2)
                     continue
             
+            # Check that all required keys were extracted
+            if required_keys:
+                missing_keys = find_missing_keys(df, required_keys)
+                if missing_keys:
+                    print(f"Warning: Missing required keys: {', '.join(missing_keys)}")
+                    
+                    if attempt < max_retries:
+                        print("Retrying with a prompt listing the missing keys...")
+                        prompt = prompt + f" WICHTIG: Folgende Schlüssel fehlen noch und müssen ebenfalls extrahiert werden: {', '.join(missing_keys)}."
+                        time.sleep(2)
+                        continue
+            
             print(f"Successfully extracted {len(df)} rows of data with {len(df.columns)} columns")
             return df
             
@@ -257,7 +469,7 @@ def upload_excel(upload_url, file_path, token):
         print(f"Error uploading Excel file: {str(e)}")
         return None
 
-def generate_excel(urls=None, output_path=None, upload_url=None, save_locally=True, return_bytes=False):
+def generate_excel(urls=None, output_path=None, upload_url=None, save_locally=True, return_bytes=False, stream=False, on_row=None):
     """
     Process images from URLs, generate Excel file, and optionally upload it.
     
@@ -267,6 +479,8 @@ def generate_excel(urls=None, output_path=None, upload_url=None, save_locally=Tr
         upload_url: URL to upload the Excel file to
         save_locally: Whether to save the file locally (default: True)
         return_bytes: If True, return the Excel data as bytes instead of saving to file
+        stream: Whether to stream the model responses and parse rows as they arrive (default: False)
+        on_row: Optional callback on_row(sheet_name, attempt, row) for each streamed row
         
     Returns:
         If return_bytes is True, returns the Excel file as bytes
@@ -308,33 +522,32 @@ def generate_excel(urls=None, output_path=None, upload_url=None, save_locally=Tr
         }
     ]
 
-    # Create a dictionary to store all dataframes
-    all_dfs = {}
-
-    # Process each of the first three images
-    for img in image_configs:
-        df = process_image(img["path"], img["prompt"], img["sheet_name"], max_retries=3)
-        all_dfs[img["sheet_name"]] = df
-
     # Define a more specific and structured prompt for the overview image
     overview_prompt = """Was ist in diesem Bild? Bitte analysiere das bereitgestellte Bild und extrahiere die Daten. 
                  ALLE schlüssel-wert-paare, die zu den folgenden schlüssel gehören 'Laufzeit Heute' 'Vorrat' 'Gesamt Heute' 'Gesamt Gestern' 'Aktuell', 'LR1', 'Pumpe', 'Betriebsst. F TR' 'Betriebsst. F LR2' 'Betriebsst. F LR1' 'Betriebsst. GRL TR1' 'Betriebsst. GRL TR2' 'Betriebsst. GRL TR3' 'Betriebsst. VG Pumpe' 'Betriebsst. Fackel' 'Betriebsst. BHKW' 'Gas Gesamt BHKW' !!!. 
                  ohne Kaskadierung und in einer csv-format
                  WICHTIG: Antworte NUR mit einer sauberen CSV-Tabelle ohne Einleitung und ohne Abschlusstext."""
 
-    # Process the overview image separately with the special prompt
-    print("Processing overview image...")
-    overview_df = process_image(urls["Overview_Page"], overview_prompt, "Overview_Page", max_retries=5)  # More retries for overview
-    all_dfs["Overview_Page"] = overview_df
+    # Create a dictionary to store all dataframes
+    all_dfs = {}
 
     # Generate Excel file in memory first (needed for both saving and uploading)
     output_buffer = BytesIO()
     
-    # Create Excel writer using the BytesIO buffer
+    # Create Excel writer using the BytesIO buffer, each sheet is added as soon as its image is processed
     with pd.ExcelWriter(output_buffer, engine='xlsxwriter') as writer:
-        # Write each dataframe to a different sheet
-        for sheet_name, df in all_dfs.items():
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
+        # Process each of the first three images
+        for img in image_configs:
+            df = process_image(img["path"], img["prompt"], img["sheet_name"], max_retries=3, stream=stream, on_row=on_row)
+            all_dfs[img["sheet_name"]] = df
+            df.to_excel(writer, sheet_name=img["sheet_name"], index=False)
+
+        # Process the overview image separately with the special prompt
+        print("Processing overview image...")
+        overview_df = process_image(urls["Overview_Page"], overview_prompt, "Overview_Page", max_retries=5,  # More retries for overview
+                                    stream=stream, required_keys=OVERVIEW_KEYS, on_row=on_row)
+        all_dfs["Overview_Page"] = overview_df
+        overview_df.to_excel(writer, sheet_name="Overview_Page", index=False)
     
     # Get the bytes from the BytesIO object
     output_buffer.seek(0)
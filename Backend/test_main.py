@@ -0,0 +1,158 @@
+import os
+from io import StringIO
+
+import pandas as pd
+import pytest
+
+# main creates the OpenAI client on import
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import main
+from main import OVERVIEW_KEYS, find_missing_keys, iter_stream_text, parse_csv_line, stream_csv_rows
+
+
+def chunked(text, size=3):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class Event:
+    def __init__(self, type, delta=None):
+        self.type = type
+        self.delta = delta
+
+
+class FakeStream(list):
+    def close(self):
+        pass
+
+
+class FakeResponses:
+    def __init__(self, text):
+        self.text = text
+        self.calls = 0
+
+    def create(self, **kwargs):
+        self.calls += 1
+        return FakeStream(Event("response.output_text.delta", chunk) for chunk in chunked(self.text))
+
+
+class FakeClient:
+    def __init__(self, text):
+        self.responses = FakeResponses(text)
+
+
+def test_parse_csv_line():
+    assert parse_csv_line("Vorrat, 12") == ["Vorrat", "12"]
+    assert parse_csv_line('Laufzeit Heute,"12,5 h"') == ["Laufzeit Heute", "12,5 h"]
+    assert parse_csv_line("Vorrat,12,m3") == ["Vorrat", "12", "m3"]
+    assert parse_csv_line("Hier ist die Tabelle:") is None
+    assert parse_csv_line(",12") is None
+
+
+def test_stream_csv_rows_fences_split_across_chunks():
+    text = "```csv\nParameter,Wert\nLaufzeit Heute,\"12,5 h\"\nVorrat,3\n```\nHier noch Text, ohne Ende"
+    header = []
+    rows = list(stream_csv_rows(chunked(text), header=header))
+    assert rows == [["Laufzeit Heute", "12,5 h"], ["Vorrat", "3"]]
+    assert header == ["Parameter", "Wert"]
+
+
+def test_stream_csv_rows_first_row_is_header():
+    header = []
+    rows = list(stream_csv_rows(chunked("Bezeichnung,Wert\nVorrat,12\n"), header=header))
+    assert rows == [["Vorrat", "12"]]
+    assert header == ["Bezeichnung", "Wert"]
+
+
+def test_stream_csv_rows_keeps_all_columns():
+    header = []
+    rows = list(stream_csv_rows(chunked("Parameter,Wert,Einheit\nVorrat,12,m3\n"), header=header))
+    assert rows == [["Vorrat", "12", "m3"]]
+    assert header == ["Parameter", "Wert", "Einheit"]
+
+
+def test_stream_csv_rows_skips_intro_before_header():
+    header = []
+    text = "Hier sind die Daten, wie gewünscht:\nParameter,Wert\nVorrat,12\n"
+    assert list(stream_csv_rows(chunked(text), header=header)) == [["Vorrat", "12"]]
+    assert header == ["Parameter", "Wert"]
+
+
+def test_stream_csv_rows_skips_intro_before_fence():
+    header = []
+    text = "Hier sind die Daten, bitte sehr\nKurz gesagt\n```\nParameter,Wert\nVorrat,12\nPumpe,An\n```"
+    assert list(stream_csv_rows(chunked(text), header=header)) == [["Vorrat", "12"], ["Pumpe", "An"]]
+    assert header == ["Parameter", "Wert"]
+
+
+def test_stream_csv_rows_skips_repeated_header():
+    text = "Parameter,Wert\nVorrat,12\nparameter,wert\nPumpe,An"
+    assert list(stream_csv_rows(chunked(text))) == [["Vorrat", "12"], ["Pumpe", "An"]]
+
+
+def test_stream_csv_rows_ignores_section_titles_and_closing_text():
+    text = ("Parameter,Wert\nBetriebsstunden\nBetriebsst. F TR,10\nFackel\nBetriebsst. Fackel,2\n"
+            "BHKW\nBetriebsst. BHKW,3\nGas\nGas Gesamt BHKW,4\n"
+            "Hinweis: Werte gerundet.\nQuelle: Bild\nStand: heute\nEnde\n")
+    rows = list(stream_csv_rows(chunked(text)))
+    assert [row[0] for row in rows] == ["Betriebsst. F TR", "Betriebsst. Fackel", "Betriebsst. BHKW", "Gas Gesamt BHKW"]
+
+
+def test_stream_csv_rows_bad_line_threshold():
+    text = "foo\nbar\nbaz\nParameter,Wert\nVorrat,12\n"
+    assert list(stream_csv_rows(chunked(text))) == [["Vorrat", "12"]]
+
+    consumed = []
+
+    def chunks():
+        for chunk in chunked("foo\nbar\nbaz\nqux\nParameter,Wert\nVorrat,12\n"):
+            consumed.append(chunk)
+            yield chunk
+
+    with pytest.raises(ValueError):
+        list(stream_csv_rows(chunks()))
+    # Parsing aborts before the rest of the stream is read
+    assert "Vorrat,12" not in "".join(consumed)
+
+
+def test_iter_stream_text_fails_on_incomplete_response():
+    events = [Event("response.output_text.delta", "Vorrat,12\n"), Event("response.incomplete")]
+    with pytest.raises(RuntimeError):
+        list(iter_stream_text(events))
+
+
+def test_find_missing_keys_requires_own_parameter():
+    df = pd.DataFrame({"Parameter": ["Betriebsst. F LR1", "Betriebsst. VG Pumpe"], "Wert": [1, 2]})
+    missing = find_missing_keys(df, ["LR1", "Pumpe", "Betriebsst. F LR1", "Betriebsst. VG Pumpe"])
+    assert missing == ["LR1", "Pumpe"]
+
+
+def test_find_missing_keys_normalises_names():
+    df = pd.DataFrame({"Parameter": ["laufzeit  heute", "LR1 Status", "Aktuell (m³/h)"], "Wert": [1, 2, 3]})
+    assert find_missing_keys(df, ["Laufzeit Heute", "LR1", "Aktuell", "Vorrat"]) == ["Vorrat"]
+
+
+def test_find_missing_keys_empty_dataframe():
+    df = pd.DataFrame(columns=["Parameter", "Value"])
+    assert find_missing_keys(df, OVERVIEW_KEYS) == OVERVIEW_KEYS
+
+
+def test_process_image_stream_matches_read_csv(monkeypatch):
+    text = "Bezeichnung,Wert,Einheit\nVorrat,12,m3\nTemperatur,3.5,°C\nPumpe,An,\n"
+    fake_client = FakeClient(text)
+    monkeypatch.setattr(main, "client", fake_client)
+    df = main.process_image("https://example.com/image.jpg", "prompt", "First_Photo", stream=True)
+    pd.testing.assert_frame_equal(df, pd.read_csv(StringIO(text)))
+    assert fake_client.responses.calls == 1
+
+
+def test_process_image_callback_errors_do_not_retry(monkeypatch):
+    fake_client = FakeClient("Parameter,Wert\nVorrat,12\nPumpe,An\n")
+    monkeypatch.setattr(main, "client", fake_client)
+
+    def on_row(sheet_name, attempt, row):
+        raise RuntimeError("consumer failed")
+
+    df = main.process_image("https://example.com/image.jpg", "prompt", "First_Photo", stream=True, on_row=on_row)
+    assert list(df["Parameter"]) == ["Vorrat", "Pumpe"]
+    assert fake_client.responses.calls == 1